@@ -3,9 +3,13 @@ import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
 import rasterio
-from rasterstats import zonal_stats
+from rasterio import features, windows
+from shapely.geometry import box
 import numpy as np
 import unicodedata
+import os
+import io
+from concurrent.futures import ThreadPoolExecutor
 
 # ==============================
 # Funciones auxiliares
@@ -18,29 +22,250 @@ def normalize_str(s):
         if unicodedata.category(c) != "Mn"
     ).upper()
 
-def compute_stats(gdf, src, band=1):
-    """Calcular estadísticas zonales para una banda específica."""
-    affine = src.transform
-    array = src.read(band)
-
-    stats = zonal_stats(
-        vectors=gdf,
-        raster=array,
-        affine=affine,
-        stats=["count", "mean", "min", "max", "std"],
-        add_stats={
-            "p10": lambda x: np.nanpercentile(np.array(x, copy=True), 10) if len(x) > 0 else np.nan,
-            "p90": lambda x: np.nanpercentile(np.array(x, copy=True), 90) if len(x) > 0 else np.nan,
-            "range": lambda x: (np.nanmax(x) - np.nanmin(x)) if len(x) > 0 else np.nan,
-        },
-        nodata=src.nodata
+def normalize_series(s):
+    """Versión vectorizada de normalize_str para una Serie de texto."""
+    return (
+        s.astype(str)
+        .str.normalize("NFD")
+        .str.replace("[\u0300-\u036f]", "", regex=True)
+        .str.upper()
     )
 
-    df = pd.DataFrame(stats)
+def zones_in_raster(gdf, src):
+    """Distritos que intersectan la extensión del raster (consulta al índice espacial)."""
+    idx = gdf.sindex.query(box(*src.bounds), predicate="intersects")
+    return gdf.iloc[np.sort(idx)]
+
+def zones_window(gdf, src):
+    """Ventana del raster que cubre la extensión de los distritos."""
+    win = windows.from_bounds(*gdf.total_bounds, transform=src.transform)
+    col_off = int(np.floor(win.col_off))
+    row_off = int(np.floor(win.row_off))
+    width = int(np.ceil(win.col_off + win.width)) - col_off
+    height = int(np.ceil(win.row_off + win.height)) - row_off
+    full = windows.Window(0, 0, src.width, src.height)
+    return windows.Window(col_off, row_off, width, height).intersection(full)
+
+def rasterize_zones(gdf, src, window):
+    """Etiquetar cada píxel de la ventana con el FID + 1 del distrito que lo contiene (0 = fuera)."""
+    shapes = [(geom, fid + 1) for geom, fid in zip(gdf.geometry, gdf["FID"])]
+    return features.rasterize(
+        shapes,
+        out_shape=(int(window.height), int(window.width)),
+        transform=src.window_transform(window),
+        fill=0,
+        dtype="int32",
+    )
+
+def compute_stats(labels, array, n_zones, nodata=None, band=1):
+    """Calcular estadísticas zonales de una banda a partir de las etiquetas rasterizadas."""
+    labels_flat = labels.ravel()
+    values = array.ravel()
+
+    valid = (labels_flat > 0) & ~np.isnan(values)
+    if nodata is not None:
+        valid &= values != nodata
+    lab = labels_flat[valid]
+    vals = values[valid]  # float32: la banda se lee con out_dtype="float32"
+
+    # Momentos por zona: n, Σx y Σx² en una pasada de bincount cada uno
+    # (acumulados en float64 para evitar cancelación en la varianza)
+    vals64 = vals.astype(np.float64)
+    count = np.bincount(lab, minlength=n_zones + 1)[1:]
+    s1 = np.bincount(lab, weights=vals64, minlength=n_zones + 1)[1:]
+    s2 = np.bincount(lab, weights=vals64 * vals64, minlength=n_zones + 1)[1:]
+    empty = count == 0
+    nz = ~empty
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = s1 / count
+        std = np.sqrt(np.maximum(s2 / count - mean * mean, 0.0)).astype(np.float32)
+    mean = mean.astype(np.float32)
+
+    # Ordenar una sola vez por (zona, valor): cada zona queda en un tramo
+    # contiguo y ordenado, de donde salen min/max (extremos) y percentiles
+    order = np.lexsort((vals, lab))
+    sorted_vals = vals[order]
+    ends = np.cumsum(count)
+    starts = ends - count
+
+    vmin = np.full(n_zones, np.nan, dtype=np.float32)
+    vmax = np.full(n_zones, np.nan, dtype=np.float32)
+    vmin[nz] = sorted_vals[starts[nz]]
+    vmax[nz] = sorted_vals[ends[nz] - 1]
+
+    # Interpolación lineal dentro de cada tramo, igual que np.percentile
+    pcts = np.full((n_zones, 2), np.nan, dtype=np.float32)
+    for j, q in enumerate((0.10, 0.90)):
+        pos = starts[nz] + q * (count[nz] - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, ends[nz] - 1)
+        frac = (pos - lo).astype(np.float32)
+        pcts[nz, j] = sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * frac
+
+    df = pd.DataFrame({
+        "FID": np.arange(n_zones),
+        "min": vmin,
+        "max": vmax,
+        "mean": mean,
+        "count": count,
+        "std": std,
+        "p10": pcts[:, 0],
+        "p90": pcts[:, 1],
+    })
+    df["range"] = df["max"] - df["min"]
     df["BAND"] = band
     df["YEAR"] = 2019 + band  # Ajusta según tu metadata
     return df
 
+def compute_band_stats(raster_file, window, labels, n_zones, band):
+    """Leer una banda con su propio handle (seguro entre hilos) y calcular sus estadísticas."""
+    with rasterio.open(raster_file) as src:
+        array = src.read(band, window=window, out_dtype="float32")
+        return compute_stats(labels, array, n_zones, nodata=src.nodata, band=band)
+
+@st.cache_resource
+def load_gdf(path, crs=None):
+    """Leer los distritos una sola vez por sesión, proyectados al CRS del raster (WKT).
+
+    La versión proyectada se guarda como GeoParquet junto al shapefile y se
+    reutiliza mientras no haya archivos del shapefile más recientes.
+    """
+    base = os.path.splitext(path)[0]
+    cache_path = base + ".parquet"
+    sources = [base + ext for ext in (".shp", ".dbf", ".shx", ".prj")]
+    source_mtime = max((os.path.getmtime(f) for f in sources if os.path.exists(f)), default=0)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= source_mtime:
+        gdf = gpd.read_parquet(cache_path)
+        stale = False
+    else:
+        gdf = gpd.read_file(path)
+        stale = True
+    if crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+        stale = True
+    if stale:
+        try:
+            gdf.to_parquet(cache_path, index=False)
+        except OSError:
+            pass  # Sin permisos de escritura: se usa la capa en memoria
+
+    gdf["FID"] = np.arange(len(gdf))  # Clave para unir con las estadísticas por banda
+    return gdf
+
+@st.cache_resource
+def load_plot_gdf(path, crs=None, tolerance=0.005):
+    """Geometrías simplificadas (tolerancia en unidades del CRS), solo para dibujar el mapa."""
+    plot_gdf = load_gdf(path, crs)[["FID", "geometry"]].copy()
+    plot_gdf["geometry"] = plot_gdf.geometry.simplify(tolerance, preserve_topology=True)
+    return plot_gdf
+
+def prefer_cog(path):
+    """Usar la versión Cloud-Optimized GeoTIFF (sufijo _cog) si existe junto al raster."""
+    cog_path = os.path.splitext(path)[0] + "_cog.tif"
+    return cog_path if os.path.exists(cog_path) else path
+
+@st.cache_resource
+def load_raster(path):
+    """Abrir el GeoTIFF una sola vez por sesión."""
+    return rasterio.open(path)
+
+@st.cache_data
+def load_tmin_stats(csv_path):
+    """Leer la tabla de estadísticas precalculadas (Parquet, reconvertido si el CSV es más reciente)."""
+    parquet_path = os.path.splitext(csv_path)[0] + ".parquet"
+    if (
+        os.path.exists(parquet_path)
+        and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)
+    ):
+        return pd.read_parquet(parquet_path)
+
+    df = pd.read_csv(csv_path, na_values=["--"])  # TMIN_range usa "--" en zonas vacías
+    dtypes = {c: "category" for c in ["DEPARTAMEN", "PROVINCIA", "DISTRITO"]}
+    dtypes["UBIGEO"] = "int32"
+    for c in ["min", "max", "mean", "std", "p10", "p90", "range"]:
+        dtypes[f"TMIN_{c}"] = "float32"
+    df = df.astype(dtypes)
+    try:
+        df.to_parquet(parquet_path, index=False)
+    except OSError:
+        pass  # Sin permisos de escritura: se usa la tabla en memoria
+    return df
+
+@st.cache_data
+def p10_summary(csv_path, departments=None):
+    """Distritos con Tmin en el percentil 10 (opcionalmente solo en ciertos departamentos)
+    y su promedio por departamento."""
+    t_min_stats = load_tmin_stats(csv_path)
+    if departments is not None:
+        t_min_stats = t_min_stats[normalize_series(t_min_stats["DEPARTAMEN"]).isin(departments)]
+
+    p10 = t_min_stats["TMIN_mean"].quantile(0.10)
+    target = t_min_stats.loc[
+        t_min_stats["TMIN_mean"] <= p10,
+        ["DEPARTAMEN", "PROVINCIA", "DISTRITO", "UBIGEO", "TMIN_mean"],
+    ]
+
+    # Agrupar por distrito único
+    target_unique = target.groupby(
+        ["UBIGEO", "DEPARTAMEN", "PROVINCIA", "DISTRITO"],
+        as_index=False, observed=True, sort=False,
+    )["TMIN_mean"].min()
+
+    promedio_por_depto = (
+        target_unique.groupby("DEPARTAMEN", observed=True, sort=False)["TMIN_mean"]
+        .mean()
+        .reset_index()
+    )
+    promedio_por_depto.columns = ["Departamento", "Promedio de Tmin"]
+    return target_unique, promedio_por_depto
+
+@st.cache_data
+def compute_all_stats(shp_file, raster_file):
+    """Estadísticas zonales de todas las bandas, cacheadas por ruta de archivos."""
+    src = load_raster(raster_file)
+    gdf = load_gdf(shp_file, src.crs.to_wkt())
+
+    # Rasterizar una sola vez la ventana que cubre los distritos dentro del raster
+    zones = zones_in_raster(gdf, src)
+    window = zones_window(zones, src)
+    labels = rasterize_zones(zones, src, window)
+
+    # Las bandas son independientes: procesarlas en paralelo
+    workers = min(src.count, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        all_stats = list(ex.map(
+            lambda b: compute_band_stats(raster_file, window, labels, len(gdf), b),
+            range(1, src.count + 1),
+        ))
+
+    return pd.concat(all_stats, axis=0).reset_index(drop=True)
+
+@st.cache_data
+def compute_results(shp_file, raster_file):
+    """Estadísticas por banda unidas a los atributos de los distritos (sin geometría)."""
+    src = load_raster(raster_file)
+    gdf = load_gdf(shp_file, src.crs.to_wkt())
+    stats_df = compute_all_stats(shp_file, raster_file)
+
+    # Unir atributos por FID (orden banda -> distrito de stats_df);
+    # la geometría se une solo para el mapa
+    attrs = pd.DataFrame(gdf.drop(columns="geometry"))
+    stats_long = stats_df.add_prefix("TMIN_").rename(columns={"TMIN_FID": "FID"})
+    return attrs.merge(stats_long, on="FID", how="right", validate="one_to_many")
+
+@st.cache_data
+def results_downloads(shp_file, raster_file):
+    """Bytes CSV y Parquet de la tabla de resultados, escritos directamente en buffers binarios."""
+    result = compute_results(shp_file, raster_file)
+
+    csv_buf = io.BytesIO()
+    result.to_csv(csv_buf, index=False, encoding="utf-8")
+
+    parquet_buf = io.BytesIO()
+    result.to_parquet(parquet_buf, index=False)
+    return csv_buf.getvalue(), parquet_buf.getvalue()
+
 # ==============================
 # Streamlit App
 # ==============================
@@ -66,12 +291,12 @@ with tabs[0]:
     """)
 
     # ✅ Carga directa de archivos locales
-    shp_file = "data/shapes/distritos.shp"
-    raster_file = "data/tmin_raster.tif"
+    shp_file = "data/shapes/DISTRITOS.shp"
+    raster_file = prefer_cog("data/tmin_raster.tif")
 
-    gdf = gpd.read_file(shp_file)
+    src = load_raster(raster_file)
 
-    src = rasterio.open(raster_file)
+    gdf = load_gdf(shp_file, src.crs.to_wkt())
     st.success("Archivos cargados automáticamente ✅")
     st.write(gdf.head())
 
@@ -81,25 +306,20 @@ with tabs[0]:
 with tabs[1]:
     st.header("Análisis Raster y Estadísticas Zonales")
 
-    all_stats = []
-    for b in range(1, src.count + 1):
-        df_band = compute_stats(gdf, src, band=b)
-        all_stats.append(df_band)
-
-    stats_df = pd.concat(all_stats, axis=0).reset_index(drop=True)
-
-    # Repetir geometrías
-    gdf_repeated = pd.concat([gdf.reset_index(drop=True)] * src.count, ignore_index=True)
-
-    # Merge final
-    result = pd.concat([gdf_repeated, stats_df.add_prefix("TMIN_")], axis=1)
+    result = compute_results(shp_file, raster_file)
 
     st.subheader("Tabla de Resultados")
     st.dataframe(result.head())
 
-    # Botón de descarga
-    csv = result.to_csv(index=False).encode("utf-8")
-    st.download_button("Descargar resultados (CSV)", csv, "tmin_stats.csv", "text/csv")
+    # Botones de descarga (bytes generados una sola vez por sesión)
+    csv_bytes, parquet_bytes = results_downloads(shp_file, raster_file)
+    st.download_button("Descargar resultados (CSV)", csv_bytes, "tmin_stats.csv", "text/csv")
+    st.download_button(
+        "Descargar resultados (Parquet)",
+        parquet_bytes,
+        "tmin_stats.parquet",
+        "application/octet-stream",
+    )
 
     # Distribución
     st.subheader("Distribución de Tmin (media distrital)")
@@ -110,11 +330,7 @@ with tabs[1]:
 
     # Ranking
     latest_year = result["TMIN_YEAR"].max()
-    ranking = (
-        result[result["TMIN_YEAR"] == latest_year]
-        .sort_values("TMIN_mean")
-        .head(15)
-    )
+    ranking = result.loc[result["TMIN_YEAR"] == latest_year].nsmallest(15, "TMIN_mean")
 
     st.subheader(f"Top 15 distritos menor temperatura mínima promedio - {latest_year}")
     fig, ax = plt.subplots(figsize=(8, 6))
@@ -122,11 +338,7 @@ with tabs[1]:
     ax.set_xlabel("Tmin (°C)")
     st.pyplot(fig)
 
-    ranking_hot = (
-    result[result["TMIN_YEAR"] == latest_year]
-    .sort_values("TMIN_mean", ascending=False)  # ordenar de mayor a menor
-    .head(15)
-)
+    ranking_hot = result.loc[result["TMIN_YEAR"] == latest_year].nlargest(15, "TMIN_mean")
 
     st.subheader(f"Top 15 distritos con mayor temperatura mínima promedio - {latest_year}")
     fig, ax = plt.subplots(figsize=(8, 6))
@@ -136,7 +348,11 @@ with tabs[1]:
 
     # Mapa coroplético
     st.subheader("Mapa: Tmin promedio por distrito")
-    gdf_latest = result[result["TMIN_YEAR"] == latest_year]
+    gdf_latest = load_plot_gdf(shp_file, src.crs.to_wkt()).merge(
+        result.loc[result["TMIN_YEAR"] == latest_year, ["FID", "TMIN_mean"]],
+        on="FID",
+        validate="one_to_one",
+    )
     fig, ax = plt.subplots(figsize=(8, 10))
     gdf_latest.plot(column="TMIN_mean", cmap="coolwarm", legend=True, ax=ax)
     ax.set_title(f"Tmin promedio distrital - {latest_year}")
@@ -144,74 +360,36 @@ with tabs[1]:
 
     st.subheader("Distritos con Tmin en el percentil 10 (más fríos)")
 
-    t_min_stats = pd.read_csv("Data/tmin_stats.csv")
-
-    # Calcular el percentil 10 global
-    global_p10 = t_min_stats["TMIN_mean"].quantile(0.10)
-
-    # Filtrar distritos ≤ p10
-    target = t_min_stats[t_min_stats["TMIN_mean"] <= global_p10]
-    target_selection = target[["DEPARTAMEN", "PROVINCIA", "DISTRITO", "UBIGEO", "TMIN_mean"]]
-
-    # Agrupar por distrito único
-    target_unique = target_selection.groupby(
-    ["UBIGEO", "DEPARTAMEN", "PROVINCIA", "DISTRITO"], 
-    as_index=False
-    )["TMIN_mean"].min()
+    tmin_csv = "data/tmin_stats.csv"
+    target_unique, promedio_por_depto = p10_summary(tmin_csv)
 
     # Mostrar resultados
     st.write("**Distritos en el percentil 10 global de Tmin:**")
     st.dataframe(target_unique)
 
     st.subheader("Departamentos presentes en el percentil 10 de Tmin")
-
-    departamentos = target_unique["DEPARTAMEN"].unique()
-
-    departamentos_df = pd.DataFrame(departamentos, columns=["Departamento"])
-    st.table(departamentos_df)
+    st.table(promedio_por_depto[["Departamento"]])
 
     promedio_tmin = target_unique["TMIN_mean"].mean()
     st.metric("Promedio de Tmin (p10 global)", f"{promedio_tmin:.2f} °C")
 
-    promedio_por_depto = target_unique.groupby("DEPARTAMEN")["TMIN_mean"].mean().reset_index()
-
-    promedio_por_depto.columns = ["Departamento", "Promedio de Tmin"]
-
     st.subheader("Promedio de Tmin por departamento (p10 global)")
     st.table(promedio_por_depto)
 
     st.subheader("Distritos amazónicos con Tmin en el percentil 10")
 
-    amazon_depts = ["LORETO", "UCAYALI", "MADRE DE DIOS"]
-    t_min_stats_amazonicos = t_min_stats[t_min_stats["DEPARTAMEN"].str.upper().isin(amazon_depts)]
-
-    global_p10_amazonicos = t_min_stats_amazonicos["TMIN_mean"].quantile(0.10)
-
-    amazon_target = t_min_stats_amazonicos[
-    t_min_stats_amazonicos["TMIN_mean"] <= global_p10_amazonicos
-    ]
-    amazon_target_selection = amazon_target[["DEPARTAMEN", "PROVINCIA", "DISTRITO", "UBIGEO", "TMIN_mean"]]
-
-    target_unique_amazonicos = amazon_target_selection.groupby(
-    ["UBIGEO", "DEPARTAMEN", "PROVINCIA", "DISTRITO"], 
-    as_index=False
-    )["TMIN_mean"].min()
+    amazon_depts = ("LORETO", "UCAYALI", "MADRE DE DIOS")
+    target_unique_amazonicos, promedio_por_depto_amazonicos = p10_summary(tmin_csv, amazon_depts)
 
     st.write("**Distritos amazónicos en el percentil 10:**")
     st.dataframe(target_unique_amazonicos)
 
-    departamentos_amaz = target_unique_amazonicos["DEPARTAMEN"].unique()
     st.subheader("Departamentos amazónicos presentes en el percentil 10 de Tmin")
-    departamentos_amazonicos_df = pd.DataFrame(departamentos, columns=["Departamento"])
-    st.table(departamentos_amazonicos_df)
+    st.table(promedio_por_depto_amazonicos[["Departamento"]])
 
     promedio_tmin_amazonicos = target_unique_amazonicos["TMIN_mean"].mean()
     st.metric("Promedio Tmin (p10 amazónico)", f"{promedio_tmin_amazonicos:.2f} °C")
 
-    promedio_por_depto_amazonicos = target_unique_amazonicos.groupby("DEPARTAMEN")["TMIN_mean"].mean()
-
-    promedio_por_depto_amazonicos.columns = ["Departamento", "Promedio de Tmin"]
-
     st.subheader("Promedio de Tmin por departamento (p10 amazónicos)")
     st.table(promedio_por_depto_amazonicos)
 